@@ -2,13 +2,17 @@ import os
 from datetime import datetime
 
 from sodapy import Socrata
+import numpy as np
 import geopandas as gpd
-import networkx as nx
 import osmnx as ox
 import matplotlib.pyplot as plt
+import shapely
+from matplotlib.colors import ListedColormap
 from matplotlib.lines import Line2D
 from shapely.geometry import Point, LineString, Polygon
-import adjustText as aT
+from pyproj import Transformer
+
+from isochrone_utils import get_graph_arrays, get_nearest_nodes, get_isochrones, clip_isochrones, rasterize_polygons, get_non_polygonal_parts
 
 ox.config(log_console=True, use_cache=True)
 ox.__version__
@@ -17,27 +21,30 @@ ox.__version__
 #plt.rcParams['savefig.facecolor']='lightskyblue'
 
 walk_speed = 3
-
-def get_isochrone_from_graph(G, x, y, walk_time=10, speed=3):
-    """Returns the coordinates of an isochrone polygon
-    given a graph and a set of coordinates.
-    Travel mode is walking.
-    Uses an average walking speed of 4.5 km/h as a default.
-    Uses 10-minute walking time as default cutoff."""
-    center_node = ox.get_nearest_node(G, (y, x))
-    meters_per_minute = speed * 1000 / 60 #km per hour to m per minute
-    for u, v, k, data in G.edges(data=True, keys=True):
-        data['time'] = data['length'] / meters_per_minute
-    subgraph = nx.ego_graph(G, center_node, radius=walk_time, distance='time')
-    node_points = [Point(data['x'], data['y']) for node, data in subgraph.nodes(data=True)]
-    polys = gpd.GeoSeries(node_points).unary_union.convex_hull
-    return polys
+graph_path = 'nyc_walk.graphml'
+pbf_path = 'new-york-latest.osm.pbf'
 
 
 # 1. Compose multi-directional graph out of New York City's walkable streets.
-nyc_boroughs_withwater = gpd.read_file('https://services5.arcgis.com/GfwWNkhOj9bNBqoJ/arcgis/rest/services/NYC_Borough_Boundary_Water_Included/FeatureServer/0/query?where=1=1&outFields=*&outSR=4326&f=pgeojson')
-Graphs = [ox.graph_from_polygon(geom, network_type='walk', simplify=False) for geom in nyc_boroughs_withwater['geometry']]
-G = nx.compose_all(Graphs)
+# The graph is saved to disk after the first download, and re-loaded from there on later runs.
+# If a local OSM extract is available, it is parsed in place of querying Overpass.
+if os.path.exists(graph_path):
+    G = ox.load_graphml(graph_path)
+else:
+    nyc_boroughs_withwater = gpd.read_file('https://services5.arcgis.com/GfwWNkhOj9bNBqoJ/arcgis/rest/services/NYC_Borough_Boundary_Water_Included/FeatureServer/0/query?where=1=1&outFields=*&outSR=4326&f=pgeojson')
+    if os.path.exists(pbf_path):
+        from pyrosm import OSM
+        osm = OSM(pbf_path, bounding_box=nyc_boroughs_withwater.unary_union)
+        nodes, edges = osm.get_network(nodes=True, network_type='walking')
+        G = ox.simplify_graph(osm.to_graph(nodes, edges, graph_type='networkx'))
+    else:
+        G = ox.graph_from_polygon(nyc_boroughs_withwater.unary_union, network_type='walk', simplify=True)
+    ox.save_graphml(G, graph_path)
+# Convert each edge's length to a walking time, once for the whole graph.
+meters_per_minute = walk_speed * 1000 / 60 #km per hour to m per minute
+for u, v, k, data in G.edges(data=True, keys=True):
+    data['time'] = data['length'] / meters_per_minute
+graph_arrays = get_graph_arrays(G)
 
 
 # 1. Authenticate user account on NYC Open Data platform (Socrata).
@@ -47,15 +54,16 @@ client = Socrata("data.cityofnewyork.us",
                  username=os.getenv('username'),
                  password=os.getenv('password'))
 
-# 2. Request records from the desired resource:
+# 2. Request records from the desired resource, selecting only the fields used below:
 results = client.get("if26-z6xq",
                      content_type='geojson',
+                     select="food_scrap_drop_off_site,the_geom",
                      limit=250)
 
 # 3. Read the records into a geodataframe
 pools_gdf = gpd.GeoDataFrame.from_features(results).set_crs(epsg=4326, inplace=True)
 print("pools_gdf columns:", pools_gdf.columns)
-pools_gdf.sort_values(by='food_scrap_drop_off_site')
+pools_gdf.sort_values(by='food_scrap_drop_off_site', inplace=True)
 pools_gdf.drop_duplicates(subset='food_scrap_drop_off_site', inplace=True, keep='last')
 pools_gdf.drop_duplicates(subset='geometry', inplace=True, keep='last')
 print(pools_gdf)
@@ -65,13 +73,20 @@ print(pools_gdf)
 
 # 5. Since the pool objects are Multipolygons, and we wish to work with point data,
 #    take the centroid of each multipolygon. We will use these centroids as proxies.
-pools_gdf['centroids'] = pools_gdf['geometry'].centroid
-pools_gdf['centroids'] = pools_gdf['centroids'].to_crs('EPSG:4326')
+# Compute all of the centroids, and re-project their coordinates, as whole arrays at once.
+centroids = shapely.centroid(np.asarray(pools_gdf['geometry'].values))
+transformer = Transformer.from_crs(pools_gdf.crs, 'EPSG:4326', always_xy=True)
+centroid_x, centroid_y = transformer.transform(shapely.get_x(centroids), shapely.get_y(centroids))
+pools_gdf['centroids'] = gpd.GeoSeries(gpd.points_from_xy(centroid_x, centroid_y), index=pools_gdf.index, crs='EPSG:4326')
+# Find the nearest graph node to every centroid in a single batched query.
+pools_gdf['nearest_node'] = get_nearest_nodes(graph_arrays, centroid_x, centroid_y)
 
 # 6. Calculate an isochrones for each centroid in the dataset, and store it to the same geodataframe.
-pools_gdf['five_min_isochrones'] = pools_gdf['centroids'].apply(lambda coor: get_isochrone_from_graph(G, coor.x, coor.y, walk_time=5, speed=walk_speed)).to_crs("EPSG:4326")
-pools_gdf['ten_min_isochrones'] = pools_gdf['centroids'].apply(lambda coor: get_isochrone_from_graph(G, coor.x, coor.y, walk_time=10, speed=walk_speed)).to_crs("EPSG:4326")
-pools_gdf['twenty_min_isochrones'] = pools_gdf['centroids'].apply(lambda coor: get_isochrone_from_graph(G, coor.x, coor.y, walk_time=20, speed=walk_speed)).to_crs("EPSG:4326")
+isochrones = get_isochrones(graph_arrays, pools_gdf['nearest_node'], walk_times=(5, 10, 20))
+five_min, ten_min, twenty_min = zip(*isochrones)
+pools_gdf['five_min_isochrones'] = gpd.GeoSeries(five_min, index=pools_gdf.index, crs="EPSG:4326")
+pools_gdf['ten_min_isochrones'] = gpd.GeoSeries(ten_min, index=pools_gdf.index, crs="EPSG:4326")
+pools_gdf['twenty_min_isochrones'] = gpd.GeoSeries(twenty_min, index=pools_gdf.index, crs="EPSG:4326")
 
 # 7. Grab data for an NYC base map, and re-project it to standard projection.
 nyc_gdf = gpd.read_file(gpd.datasets.get_path('nybb')).to_crs("EPSG:4326")
@@ -81,14 +96,26 @@ fig, ax = plt.subplots(figsize=(8,8),dpi=400)
 base = nyc_gdf.plot(ax=ax, color='lightgray', edgecolor='gray')
 
 # 9. Clip the isochrone layers to the basemap.
-pools_gdf['five_min_isochrones'] = gpd.clip(pools_gdf['five_min_isochrones'], nyc_gdf)
-pools_gdf['ten_min_isochrones'] = gpd.clip(pools_gdf['ten_min_isochrones'], nyc_gdf)
-pools_gdf['twenty_min_isochrones'] = gpd.clip(pools_gdf['twenty_min_isochrones'], nyc_gdf)
+nyc_mask = shapely.union_all(np.asarray(nyc_gdf['geometry'].values))
+shapely.prepare(nyc_mask)
+for column in ['five_min_isochrones', 'ten_min_isochrones', 'twenty_min_isochrones']:
+    pools_gdf[column] = gpd.GeoSeries(clip_isochrones(pools_gdf[column].values, nyc_mask), index=pools_gdf.index, crs="EPSG:4326")
 
 # 10. Plot the 5, 10, and 20 minute isochrones surrounding each pool.
-pools_gdf['twenty_min_isochrones'].plot(ax=base, color='#FF595E', zorder=5)
-pools_gdf['ten_min_isochrones'].plot(ax=base, color='#FFCA3A', zorder=10)
-pools_gdf['five_min_isochrones'].plot(ax=base, color='#8AC926', zorder=20)
+x_range, y_range = ax.get_xlim(), ax.get_ylim()
+width, height = (fig.get_size_inches() * fig.dpi).astype(int)
+for column, color, zorder in [('twenty_min_isochrones', '#FF595E', 5),
+                              ('ten_min_isochrones', '#FFCA3A', 10),
+                              ('five_min_isochrones', '#8AC926', 20)]:
+    covered = rasterize_polygons(pools_gdf[column].values, x_range, y_range, width, height)
+    ax.imshow(np.ma.masked_where(~covered, covered), cmap=ListedColormap([color]), extent=(*x_range, *y_range),
+              origin='lower', aspect=ax.get_aspect(), interpolation='nearest', zorder=zorder)
+    # Points and lines (e.g. hulls of isolated center nodes) cover no pixels, so draw those few directly.
+    leftovers = get_non_polygonal_parts(pools_gdf[column].values)
+    if len(leftovers):
+        gpd.GeoSeries(leftovers, crs="EPSG:4326").plot(ax=ax, color=color, zorder=zorder)
+ax.set_xlim(x_range)
+ax.set_ylim(y_range)
 
 # 11. Plot the centroids of each five-min isochrone.
 pools_gdf['repr_point'] = pools_gdf['five_min_isochrones'].centroid
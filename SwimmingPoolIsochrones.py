@@ -2,43 +2,57 @@ import os
 from datetime import datetime
 
 from sodapy import Socrata
+import numpy as np
 import geopandas as gpd
-import networkx as nx
 import osmnx as ox
 import matplotlib.pyplot as plt
+import shapely
+from matplotlib.colors import ListedColormap
 from matplotlib.lines import Line2D
 from shapely.geometry import Point, LineString, Polygon
-import adjustText as aT
+from pyproj import Transformer
+
+from isochrone_utils import get_graph_arrays, get_nearest_nodes, get_isochrones, clip_isochrones, rasterize_polygons, get_non_polygonal_parts, place_labels
 
 ox.config(log_console=True, use_cache=True)
 ox.__version__
 
-
-def get_isochrone_from_graph(G, x, y, walk_time=10, speed=3):
-    """Returns the coordinates of an isochrone polygon
-    given a graph and a set of coordinates.
-    Travel mode is walking.
-    Uses an average walking speed of 4.5 km/h as a default.
-    Uses 10-minute walking time as default cutoff."""
-    center_node = ox.get_nearest_node(G, (y, x))
-    meters_per_minute = speed * 1000 / 60 #km per hour to m per minute
-    for u, v, k, data in G.edges(data=True, keys=True):
-        data['time'] = data['length'] / meters_per_minute
-    subgraph = nx.ego_graph(G, center_node, radius=walk_time, distance='time')
-    node_points = [Point(data['x'], data['y']) for node, data in subgraph.nodes(data=True)]
-    polys = gpd.GeoSeries(node_points).unary_union.convex_hull
-    return polys
+walk_speed = 3
+graph_path = 'nyc_walk.graphml'
+pbf_path = 'new-york-latest.osm.pbf'
 
 
 """1. Compose multi-directional graph of New York City's walkable streets."""
-# Read NYC Borough Boundary polygons (with water,
-# so as to capture bridges/tunnels) from NYC DCP into a GeoDataFrame.
-nyc_boroughs_withwater = gpd.read_file('https://services5.arcgis.com/GfwWNkhOj9bNBqoJ/arcgis/rest/services/NYC_Borough_Boundary_Water_Included/FeatureServer/0/query?where=1=1&outFields=*&outSR=4326&f=pgeojson')
-# Use the borough polygons to query Open Steet Map for street data,
-# and create a list of multi-directional graphs that represent each borough's walkable street network.
-Graphs = [ox.graph_from_polygon(geom, network_type='walk', simplify=False) for geom in nyc_boroughs_withwater['geometry']]
-# Stitch the borough graphs together into a single, citywide network graph.
-G = nx.compose_all(Graphs)
+# Re-load the graph from disk if a previous run already downloaded it.
+if os.path.exists(graph_path):
+    G = ox.load_graphml(graph_path)
+else:
+    # Read NYC Borough Boundary polygons (with water,
+    # so as to capture bridges/tunnels) from NYC DCP into a GeoDataFrame.
+    nyc_boroughs_withwater = gpd.read_file('https://services5.arcgis.com/GfwWNkhOj9bNBqoJ/arcgis/rest/services/NYC_Borough_Boundary_Water_Included/FeatureServer/0/query?where=1=1&outFields=*&outSR=4326&f=pgeojson')
+    # Merge the borough polygons into a single citywide polygon, and use it to pull Open Steet Map
+    # street data into a multi-directional graph that represents the city's walkable street network.
+    # Simplifying the graph's topology collapses nodes that aren't intersections or dead-ends,
+    # while each merged edge keeps the summed length of the street segments it replaces.
+    if os.path.exists(pbf_path):
+        # Parsing a local OSM extract (e.g. from Geofabrik) is much faster than querying Overpass.
+        from pyrosm import OSM
+        osm = OSM(pbf_path, bounding_box=nyc_boroughs_withwater.unary_union)
+        nodes, edges = osm.get_network(nodes=True, network_type='walking')
+        G = ox.simplify_graph(osm.to_graph(nodes, edges, graph_type='networkx'))
+    else:
+        # Otherwise, query Overpass once for the whole city, which avoids downloading
+        # the streets shared by neighboring boroughs more than once.
+        G = ox.graph_from_polygon(nyc_boroughs_withwater.unary_union, network_type='walk', simplify=True)
+    # Save the graph to disk, so that later runs can skip the download.
+    ox.save_graphml(G, graph_path)
+# Convert each edge's length to a walking time (in minutes), once for the whole graph,
+# rather than on every isochrone calculation.
+meters_per_minute = walk_speed * 1000 / 60 #km per hour to m per minute
+for u, v, k, data in G.edges(data=True, keys=True):
+    data['time'] = data['length'] / meters_per_minute
+# Extract the graph's nodes and edges into flat arrays, which all of the later steps work from.
+graph_arrays = get_graph_arrays(G)
 
 
 """2. Query geodata on NYC's swimming pools from NYC Open Data portal."""
@@ -48,15 +62,17 @@ client = Socrata("data.cityofnewyork.us",
                  'odQdEcIxnATZPym3KySwgWw27',
                  username=os.getenv('username'),
                  password=os.getenv('password'))
-# Request records from the desired resource:
+# Request records from the desired resource, selecting only the fields used below
+# (the pools' names and park property numbers, and their geometry) to keep the payload small:
 results = client.get("qafw-han9",
                      content_type='geojson',
+                     select="name,gispropnum,the_geom",
                      limit=102)
 # Read the records into a GeoDataFrame.
 pools_gdf = gpd.GeoDataFrame.from_features(results).set_crs(epsg=4326, inplace=True)
 print("pools_gdf columns:", pools_gdf.columns)
 # Dedupe the data, to account for multiple pools that share a location (adult pool vs. kids pool).
-pools_gdf.sort_values(by='name')
+pools_gdf.sort_values(by='name', inplace=True)
 pools_gdf.drop_duplicates(subset='gispropnum', inplace=True, keep='last')
 pools_gdf.drop_duplicates(subset='name', inplace=True, keep='last')
 print(pools_gdf)
@@ -64,14 +80,22 @@ print(pools_gdf)
 """3. Calculate isochrones surrounding each swimming pool."""
 # Since the pool objects are Multipolygons, and we wish to work with point data,
 # take the centroid of each multipolygon. We will use these centroids as proxies for pool locations.
-pools_gdf['centroids'] = pools_gdf['geometry'].centroid
-pools_gdf['centroids'] = pools_gdf['centroids'].to_crs('EPSG:4326')
+# Compute all of the centroids, and re-project their coordinates, as whole arrays at once.
+centroids = shapely.centroid(np.asarray(pools_gdf['geometry'].values))
+transformer = Transformer.from_crs(pools_gdf.crs, 'EPSG:4326', always_xy=True)
+centroid_x, centroid_y = transformer.transform(shapely.get_x(centroids), shapely.get_y(centroids))
+pools_gdf['centroids'] = gpd.GeoSeries(gpd.points_from_xy(centroid_x, centroid_y), index=pools_gdf.index, crs='EPSG:4326')
+# Snap every centroid to its nearest node on the street network, using a single batched query.
+pools_gdf['nearest_node'] = get_nearest_nodes(graph_arrays, centroid_x, centroid_y)
 
 # Calculate a set of isochrones for each centroid in the dataset,
+# on the GPU if one is available, or else across all CPU cores,
 # and store them to the same GeoDataFrame.
-pools_gdf['five_min_isochrones'] = pools_gdf['centroids'].apply(lambda coor: get_isochrone_from_graph(G, coor.x, coor.y,walk_time=5)).to_crs("EPSG:4326")
-pools_gdf['ten_min_isochrones'] = pools_gdf['centroids'].apply(lambda coor: get_isochrone_from_graph(G, coor.x, coor.y,walk_time=10)).to_crs("EPSG:4326")
-pools_gdf['twenty_min_isochrones'] = pools_gdf['centroids'].apply(lambda coor: get_isochrone_from_graph(G, coor.x, coor.y,walk_time=20)).to_crs("EPSG:4326")
+isochrones = get_isochrones(graph_arrays, pools_gdf['nearest_node'], walk_times=(5, 10, 20))
+five_min, ten_min, twenty_min = zip(*isochrones)
+pools_gdf['five_min_isochrones'] = gpd.GeoSeries(five_min, index=pools_gdf.index, crs="EPSG:4326")
+pools_gdf['ten_min_isochrones'] = gpd.GeoSeries(ten_min, index=pools_gdf.index, crs="EPSG:4326")
+pools_gdf['twenty_min_isochrones'] = gpd.GeoSeries(twenty_min, index=pools_gdf.index, crs="EPSG:4326")
 
 """4. Plot the data on a map."""
 # Grab borough boundaries to use for an NYC base map, this time clipped to the shoreline,
@@ -82,13 +106,27 @@ fig, ax = plt.subplots(figsize=(8,8),dpi=400)
 base = nyc_gdf.plot(ax=ax, color='lightgray', edgecolor='gray')
 # Clip the isochrone layers to the basemap (borough boundaries),
 # to deal with edge effects caused by use of the convex hull method.
-pools_gdf['five_min_isochrones'] = gpd.clip(pools_gdf['five_min_isochrones'], nyc_gdf)
-pools_gdf['ten_min_isochrones'] = gpd.clip(pools_gdf['ten_min_isochrones'], nyc_gdf)
-pools_gdf['twenty_min_isochrones'] = gpd.clip(pools_gdf['twenty_min_isochrones'], nyc_gdf)
+nyc_mask = shapely.union_all(np.asarray(nyc_gdf['geometry'].values))
+shapely.prepare(nyc_mask)
+for column in ['five_min_isochrones', 'ten_min_isochrones', 'twenty_min_isochrones']:
+    pools_gdf[column] = gpd.GeoSeries(clip_isochrones(pools_gdf[column].values, nyc_mask), index=pools_gdf.index, crs="EPSG:4326")
 # Plot the 5, 10, and 20 minute isochrones surrounding each pool proxy.
-pools_gdf['twenty_min_isochrones'].plot(ax=base, color='#FF595E', zorder=5)
-pools_gdf['ten_min_isochrones'].plot(ax=base, color='#FFCA3A', zorder=10)
-pools_gdf['five_min_isochrones'].plot(ax=base, color='#8AC926', zorder=20)
+# Each layer is rasterized with datashader at the figure's resolution, rather than drawn polygon by polygon,
+# and laid over the base map with the base map's extent and aspect ratio.
+x_range, y_range = ax.get_xlim(), ax.get_ylim()
+width, height = (fig.get_size_inches() * fig.dpi).astype(int)
+for column, color, zorder in [('twenty_min_isochrones', '#FF595E', 5),
+                              ('ten_min_isochrones', '#FFCA3A', 10),
+                              ('five_min_isochrones', '#8AC926', 20)]:
+    covered = rasterize_polygons(pools_gdf[column].values, x_range, y_range, width, height)
+    ax.imshow(np.ma.masked_where(~covered, covered), cmap=ListedColormap([color]), extent=(*x_range, *y_range),
+              origin='lower', aspect=ax.get_aspect(), interpolation='nearest', zorder=zorder)
+    # Points and lines (e.g. hulls of isolated center nodes) cover no pixels, so draw those few directly.
+    leftovers = get_non_polygonal_parts(pools_gdf[column].values)
+    if len(leftovers):
+        gpd.GeoSeries(leftovers, crs="EPSG:4326").plot(ax=ax, color=color, zorder=zorder)
+ax.set_xlim(x_range)
+ax.set_ylim(y_range)
 
 """5. Style the map."""
 # Calculate and store the centroids of each five-min isochrone, to use as representative points for labeling.
@@ -104,17 +142,20 @@ custom_lines = [Line2D([0], [0], color='#8AC926', lw=4),
 ax.legend(custom_lines, ['5 Minutes', '10 Minutes', '20 Minutes', '>20 Minutes'], loc='lower right', title='Walk Times')
 # Add labels to each isochrone centroid (note that centroids
 # themselves are not plotted, so as to reduce visual noise).
-texts = []
-for x, y, label in zip(pools_gdf['repr_point'].x, pools_gdf['repr_point'].y, pools_gdf['name']):
-    ax.annotate(label, (x,y), zorder=100, fontsize=3, arrowprops=dict(arrowstyle="-", zorder=100, lw=.5, color='gray'))
-# Move the labels from the axis object to the figure object,
-# so that they display in the correct z order.
-i = 0
-for item in ax.texts:
-    fig.texts.append(ax.texts.pop(i))
-    i += 1
-# Use the adjustText library to iteratively adjust label positions.
-aT.adjust_text(fig.texts, force_text=0.5, expand_text=(1.2, 1.5), ax=ax)
+# Label sizes are estimated in data units from the font size, so that non-overlapping
+# positions can be found for all of the labels up front, in a single pass over a grid hash.
+fontsize = 3
+ax.apply_aspect()
+bbox = ax.get_window_extent()
+x_units_per_point = (x_range[1] - x_range[0]) / bbox.width * fig.dpi / 72
+y_units_per_point = (y_range[1] - y_range[0]) / bbox.height * fig.dpi / 72
+char_width, line_height = 0.6 * fontsize * x_units_per_point, 1.2 * fontsize * y_units_per_point
+labeled = pools_gdf[~pools_gdf['repr_point'].is_empty]
+label_x, label_y = place_labels(labeled['repr_point'].x, labeled['repr_point'].y,
+                                labeled['name'].str.len() * char_width, char_width, line_height)
+for x, y, text_x, text_y, label in zip(labeled['repr_point'].x, labeled['repr_point'].y, label_x, label_y, labeled['name']):
+    ax.annotate(label, (x, y), xytext=(text_x, text_y), ha='left', va='bottom', zorder=100, fontsize=fontsize,
+                arrowprops=dict(arrowstyle="-", zorder=100, lw=.5, color='gray'))
 plt.axis('off')
 
 """6. Save and display the new map!"""
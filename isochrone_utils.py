@@ -0,0 +1,239 @@
+from collections import namedtuple
+
+import datashader as ds
+import numpy as np
+import shapely
+import spatialpandas
+from numba import njit, prange
+from scipy.spatial import ConvexHull, QhullError
+from sklearn.neighbors import BallTree
+
+try:
+    import cudf
+    import cugraph
+except ImportError:
+    cugraph = None
+
+
+GraphArrays = namedtuple('GraphArrays', ['node_ids', 'node_x', 'node_y', 'edge_u', 'edge_v', 'edge_time'])
+
+
+def get_graph_arrays(G):
+    """Returns a GraphArrays of a graph's nodes and edges, extracted once into flat arrays.
+    Nodes are referred to by their position in node_ids, so edge_u and edge_v hold
+    the positions of each edge's endpoints, and edge_time holds its 'time' attribute.
+    Edge arrays are stored as int32 and float32, which halves the memory the shortest-path
+    searches stream through; walking times in minutes need nowhere near float64 precision."""
+    node_ids = np.array(G.nodes)
+    node_index = {node: i for i, node in enumerate(node_ids)}
+    n_nodes, n_edges = G.number_of_nodes(), G.number_of_edges()
+    return GraphArrays(
+        node_ids=node_ids,
+        node_x=np.fromiter((data['x'] for node, data in G.nodes(data=True)), np.float64, n_nodes),
+        node_y=np.fromiter((data['y'] for node, data in G.nodes(data=True)), np.float64, n_nodes),
+        edge_u=np.fromiter((node_index[u] for u, v in G.edges()), np.int32, n_edges),
+        edge_v=np.fromiter((node_index[v] for u, v in G.edges()), np.int32, n_edges),
+        edge_time=np.fromiter((data['time'] for u, v, data in G.edges(data=True)), np.float32, n_edges))
+
+
+def get_nearest_nodes(graph_arrays, x, y):
+    """Returns the position of the nearest graph node to each of a set of coordinates.
+    Builds a single haversine BallTree over the graph's nodes,
+    and queries it for all of the coordinates at once."""
+    node_coords = np.deg2rad(np.column_stack([graph_arrays.node_y, graph_arrays.node_x]))
+    tree = BallTree(node_coords, metric='haversine')
+    idx = tree.query(np.deg2rad(np.column_stack([y, x])), k=1, return_distance=False)
+    return idx[:, 0]
+
+
+def _get_convex_hull(coords):
+    # Qhull works on the coordinate array directly, but can't hull fewer than 3 non-collinear points,
+    # so those degenerate cases fall back to shapely, which returns a Point or LineString for them.
+    if len(coords) >= 3:
+        try:
+            return shapely.Polygon(coords[ConvexHull(coords).vertices])
+        except QhullError:
+            pass
+    return shapely.convex_hull(shapely.multipoints(coords))
+
+
+def _get_convex_hulls(node_x, node_y, lengths, walk_times):
+    polys = []
+    for walk_time in walk_times:
+        reached = lengths <= walk_time
+        polys.append(_get_convex_hull(np.column_stack([node_x[reached], node_y[reached]])))
+    return polys
+
+
+def to_csr(graph_arrays):
+    """Returns a graph's adjacency in compressed sparse row form,
+    as (indptr, indices, weights) arrays, with each edge weighted by its time.
+    Parallel edges are all kept, which is harmless to a shortest-path search."""
+    order = np.argsort(graph_arrays.edge_u, kind='stable')
+    indptr = np.zeros(len(graph_arrays.node_ids) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(graph_arrays.edge_u, minlength=len(graph_arrays.node_ids)), out=indptr[1:])
+    return indptr, graph_arrays.edge_v[order], graph_arrays.edge_time[order]
+
+
+@njit(cache=True)
+def _bounded_dijkstra(indptr, indices, weights, source, cutoff, lengths):
+    # Binary heap of (length, node) pairs, with stale entries skipped when popped.
+    # Every push follows a successful relaxation, so it never holds more than one entry per edge.
+    heap_lengths = np.empty(len(indices) + 1, dtype=weights.dtype)
+    heap_nodes = np.empty(len(indices) + 1, dtype=indices.dtype)
+    heap_lengths[0] = 0
+    heap_nodes[0] = source
+    size = 1
+    lengths[source] = 0
+    while size > 0:
+        length = heap_lengths[0]
+        node = heap_nodes[0]
+        size -= 1
+        last_length = heap_lengths[size]
+        last_node = heap_nodes[size]
+        i = 0
+        while 2 * i + 1 < size:
+            child = 2 * i + 1
+            if child + 1 < size and heap_lengths[child + 1] < heap_lengths[child]:
+                child += 1
+            if heap_lengths[child] >= last_length:
+                break
+            heap_lengths[i] = heap_lengths[child]
+            heap_nodes[i] = heap_nodes[child]
+            i = child
+        heap_lengths[i] = last_length
+        heap_nodes[i] = last_node
+        if length > lengths[node]:
+            continue
+        for edge in range(indptr[node], indptr[node + 1]):
+            neighbor = indices[edge]
+            new_length = length + weights[edge]
+            if new_length <= cutoff and new_length < lengths[neighbor]:
+                lengths[neighbor] = new_length
+                i = size
+                size += 1
+                while i > 0 and heap_lengths[(i - 1) // 2] > new_length:
+                    heap_lengths[i] = heap_lengths[(i - 1) // 2]
+                    heap_nodes[i] = heap_nodes[(i - 1) // 2]
+                    i = (i - 1) // 2
+                heap_lengths[i] = new_length
+                heap_nodes[i] = neighbor
+
+
+@njit(parallel=True, cache=True)
+def _bounded_dijkstra_batch(indptr, indices, weights, sources, cutoff):
+    lengths = np.full((len(sources), len(indptr) - 1), np.inf, dtype=weights.dtype)
+    for i in prange(len(sources)):
+        _bounded_dijkstra(indptr, indices, weights, sources[i], cutoff, lengths[i])
+    return lengths
+
+
+def get_isochrones_on_cpu(graph_arrays, center_nodes, walk_times=(5, 10, 20), batch_size=64):
+    """Returns a list of isochrone polygon lists, one per center node position.
+    Converts the graph to CSR arrays once, then runs the center nodes' shortest-path searches,
+    cut off at the longest walk time, across all CPU cores with Numba.
+    Center nodes are processed batch_size at a time, to bound the memory used for path lengths."""
+    indptr, indices, weights = to_csr(graph_arrays)
+    sources = np.asarray(center_nodes, dtype=indices.dtype)
+    isochrones = []
+    for start in range(0, len(sources), batch_size):
+        lengths = _bounded_dijkstra_batch(indptr, indices, weights, sources[start:start + batch_size], max(walk_times))
+        isochrones.extend(_get_convex_hulls(graph_arrays.node_x, graph_arrays.node_y, row, walk_times)
+                          for row in lengths)
+    return isochrones
+
+
+def get_isochrones_on_gpu(graph_arrays, center_nodes, walk_times=(5, 10, 20)):
+    """Returns a list of isochrone polygon lists, one per center node position.
+    Copies the graph's edges to the GPU once, keeping the fastest of any parallel edges,
+    and runs each center node's shortest-path search there with cuGraph,
+    cut off at the longest walk time."""
+    edgelist = cudf.DataFrame({'src': graph_arrays.edge_u,
+                               'dst': graph_arrays.edge_v,
+                               'time': graph_arrays.edge_time})
+    edgelist = edgelist.groupby(['src', 'dst'], as_index=False)['time'].min()
+    gpu_G = cugraph.Graph(directed=True)
+    gpu_G.from_cudf_edgelist(edgelist, source='src', destination='dst', edge_attr='time', renumber=False)
+    isochrones = []
+    for node in center_nodes:
+        distances = cugraph.sssp(gpu_G, int(node), cutoff=max(walk_times)).to_pandas()
+        lengths = np.full(len(graph_arrays.node_ids), np.inf)
+        lengths[distances['vertex'].to_numpy()] = distances['distance'].to_numpy()
+        isochrones.append(_get_convex_hulls(graph_arrays.node_x, graph_arrays.node_y, lengths, walk_times))
+    return isochrones
+
+
+def get_isochrones(graph_arrays, center_nodes, walk_times=(5, 10, 20)):
+    """Returns a list of isochrone polygon lists, one per center node position.
+    Sites that snap to the same center node share a single computation.
+    Runs on the GPU when cuGraph is installed, and across all CPU cores otherwise."""
+    unique_nodes, inverse = np.unique(np.asarray(center_nodes), return_inverse=True)
+    if cugraph is not None:
+        isochrones = get_isochrones_on_gpu(graph_arrays, unique_nodes, walk_times)
+    else:
+        isochrones = get_isochrones_on_cpu(graph_arrays, unique_nodes, walk_times)
+    return [isochrones[i] for i in inverse.ravel()]
+
+
+def clip_isochrones(isochrones, mask):
+    """Returns an array of isochrone polygons clipped to a mask polygon.
+    Expects the mask to have been prepared with shapely.prepare, so that the
+    isochrones lying wholly inside it can be found quickly and passed through unchanged,
+    leaving only the rest to be intersected with it."""
+    isochrones = np.asarray(isochrones)
+    clipped = isochrones.copy()
+    crosses = ~shapely.contains_properly(mask, isochrones)
+    clipped[crosses] = shapely.intersection(isochrones[crosses], mask)
+    return clipped
+
+
+def rasterize_polygons(polygons, x_range, y_range, width, height):
+    """Returns a boolean raster, of shape (height, width), of the pixels covered by any of a set of polygons.
+    Rows run from the bottom of y_range to the top. Uses datashader's polygon rasterizer,
+    so that large numbers of polygons are drawn in a single compiled pass.
+    Each geometry is first split into its parts, so that the polygonal parts of a GeometryCollection
+    (e.g. from clipping a hull that touches the mask's boundary) are still drawn.
+    Empty and non-polygonal parts (e.g. degenerate convex hulls) cover no pixels, and are skipped."""
+    parts = shapely.get_parts(np.asarray(polygons))
+    parts = parts[(shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)]
+    multipolygons = [shapely.MultiPolygon([polygon]) for polygon in parts]
+    sdf = spatialpandas.GeoDataFrame({'geometry': spatialpandas.geometry.MultiPolygonArray(multipolygons)})
+    canvas = ds.Canvas(plot_width=width, plot_height=height, x_range=x_range, y_range=y_range)
+    return canvas.polygons(sdf, geometry='geometry', agg=ds.any()).values.astype(bool)
+
+
+def get_non_polygonal_parts(geometries):
+    """Returns an array of the non-empty parts of a set of geometries that aren't polygons,
+    i.e. the points and lines that rasterize_polygons skips, such as degenerate convex hulls."""
+    parts = shapely.get_parts(np.asarray(geometries))
+    return parts[(shapely.get_type_id(parts) != 3) & ~shapely.is_empty(parts)]
+
+
+def place_labels(x, y, widths, cell_width, cell_height, max_offset=20):
+    """Returns arrays of x and y positions for the lower-left corners of a set of labels,
+    each placed as close as possible to its anchor point (x, y) without overlapping another label.
+    Labels are placed in order onto a grid hash of cell_width by cell_height cells,
+    each taking up as many cells in its row as its width needs. Each label only checks
+    the cells within max_offset cells of its anchor, so placement takes linear time.
+    Labels with no free spot within that distance, or with a missing anchor or width,
+    are left at their anchor."""
+    x, y, widths = np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(widths, dtype=float)
+    label_x, label_y = x.copy(), y.copy()
+    offsets = sorted(((d_col, d_row) for d_col in range(-max_offset, max_offset + 1)
+                      for d_row in range(-max_offset, max_offset + 1)),
+                     key=lambda offset: (offset[0] * cell_width) ** 2 + (offset[1] * cell_height) ** 2)
+    occupied = set()
+    for i in range(len(x)):
+        if not (np.isfinite(x[i]) and np.isfinite(y[i]) and np.isfinite(widths[i])):
+            continue
+        span = max(1, int(np.ceil(widths[i] / cell_width)))
+        col = int(np.floor(x[i] / cell_width)) - span // 2
+        row = int(np.floor(y[i] / cell_height))
+        for d_col, d_row in offsets:
+            cells = {(col + d_col + k, row + d_row) for k in range(span)}
+            if not cells & occupied:
+                occupied |= cells
+                label_x[i] = (col + d_col) * cell_width
+                label_y[i] = (row + d_row) * cell_height
+                break
+    return label_x, label_y